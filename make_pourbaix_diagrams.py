@@ -1,115 +1,152 @@
 import re
+import csv
 import json
 import gzip
+import zlib
+import pickle
 import shutil
+import os
+from glob import glob
 from time import time
-from gzip import BadGzipFile
-from hashlib import md5
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import itertools
 import argparse
+import numpy as np
 import pandas as pd
 from pymatgen.analysis.pourbaix_diagram import PourbaixDiagram
 from monty.json import MontyDecoder
 
-parser = argparse.ArgumentParser(description='Decomposition energies from a Pourbaix diagram.')
-
-parser.add_argument('-j', '--job-number', type=int, default=None,
-                    help='Job number for parallel runs (starting from 0)')
-parser.add_argument('-n', '--njobs', type=int, default=None,
-                    help='Total number of parallel jobs')
-
-# Optional global conditions CSV
-parser.add_argument('-g', '--global-conditions', type=str, default=None,
-                    help='Path to CSV file with columns ph,voltage for global conditions')
-
-# Optional material-specific conditions CSV
-parser.add_argument('-m', '--material-conditions', type=str, default=None,
-                    help='Path CSV file with columns material_id,ph,voltage for material-specific conditions')
-
-# Optional direct conditions from command line
-parser.add_argument('-p', '--ph', type=str, default=None,
-                    help='Single or comma-separated pH values')
-parser.add_argument('-v', '--voltage', type=str, default=None,
-                    help='Single comma-separated voltage values (Cartesian product with pH values will be used)')
-
-args = parser.parse_args()
-
-# Initialize empty data structures to hold conditions
-global_conditions = []
-material_conditions = dict()
-
-# Check at least one condition source is provided
-if not (args.global_conditions is not None or
-        args.material_conditions is not None or
-        (args.ph is not None and args.voltage is not None)):
-    raise ValueError('You must specify at least one method for conditions: global file, material-specific file, or direct --ph and --voltage arguments.')
-
-# Read global conditions file if provided
-if args.global_conditions is not None:
-    global_df = pd.read_csv(args.global_conditions)
-    global_cols = set(global_df.columns)
-    if 'ph' not in global_cols or 'voltage' not in global_cols:
-        raise ValueError('Global conditions file must have columns "ph" and "voltage".')
-    global_conditions.extend(zip(global_df.ph, global_df.voltage))
-
-# Add Cartesian product of conditions directly from the command line if provided
-if (args.ph is not None) and (args.voltage is not None):
-    ph_list = [float(p) for p in args.ph.split(',')]
-    voltage_list = [float(v) for v in args.voltage.split(',')]
-    global_conditions.extend(itertools.product(ph_list, voltage_list))
-elif (args.ph is not None) or (args.voltage is not None):
-    raise ValueError('You must specify both --ph and --voltage if specifying conditions directly.')
-
-# Read material-specific conditions file if provided
-if args.material_conditions:
-    material_df = pd.read_csv(args.material_conditions)
-    material_cols = set(material_df.columns)
-    if 'material_id' not in material_cols or 'ph' not in material_cols or 'voltage' not in material_cols:
-        raise ValueError('Material conditions file must have columns "material_id", "ph", and "voltage".')
-    for material_id, df in material_df.groupby('material_id'):
-        if material_id not in material_conditions:
-            material_conditions[material_id] = []
-        material_conditions[material_id].extend(zip(df.ph, df.voltage))
-
-# Optional argument to split into jobs
-if (args.job_number is None) != (args.njobs is None):
-    raise ValueError('You must specify both --job-number and --njobs, or neither.')
-
-if args.job_number is None:
-    job_number = None
-    njobs = None
-else:
-    if args.job_number < 0 or args.job_number >= args.njobs:
-        raise ValueError('job-number must be in range [0, njobs - 1]')
-    print(f'Running job number {args.job_number} of {args.njobs} jobs')
-    job_number = args.job_number
-    njobs = args.njobs
-
 # Pourbaix diagram tutorial:
 # https://matgenb.materialsvirtuallab.org/2017/12/15/Plotting-a-Pourbaix-Diagram.html
 
-def finish(data_tbl_rows, diagram_tbl_rows, old_data_tbl, old_diagram_tbl,
-           data_outpath, diagram_outpath):
-    new_data_tbl = pd.DataFrame(data_tbl_rows)
-    combined_data_tbl = pd.concat([old_data_tbl, new_data_tbl],
-                                  ignore_index=True)
-    tmp_data_outpath = data_outpath + '.tmp'
-    combined_data_tbl.to_csv(tmp_data_outpath,
-                             index=False, compression = 'gzip')
-    shutil.move(tmp_data_outpath, data_outpath)
-
-    new_diagram_tbl = pd.DataFrame(diagram_tbl_rows)
-    combined_diagram_tbl = pd.concat([old_diagram_tbl, new_diagram_tbl],
-                                      ignore_index=True)
-    tmp_diagram_outpath = diagram_outpath + '.tmp'
-    combined_diagram_tbl.to_csv(tmp_diagram_outpath,
-                                index=False, compression = 'gzip')
-    shutil.move(tmp_diagram_outpath, diagram_outpath)
-
-def safeint(r):
-    '''Safe conversion to an integer'''
-    n = int(r)
-    if abs(n - r) > 1e-5:
+# Columns of the output tables. Rows are accumulated column by column, as a
+# dictionary from column name to a list of values
+DATA_COLUMNS = ('symbols', 'name', 'entry_id', 'ph', 'voltage',
+                'decomposition_energy', 'decomposition_energy_lookup_time')
+DIAGRAM_COLUMNS = ('symbols', 'name', 'entry_id', 'diagram_time')
+
+# Materials Project id at the start of an entry id
+ENTRY_ID_REGEX = re.compile(r'^(mp|mvc)-\d+')
+
+def ensure_gzipped(path):
+    '''If the file at this path exists but isn't gzipped, compress it in
+    place, so that gzipped rows can be appended to it'''
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(2)
+    except FileNotFoundError:
+        return
+    # Empty files are fine, and get a header on the first append
+    if magic == b'' or magic == b'\x1f\x8b':
+        return
+    # I messed up a run and didn't save as gzip, but did save with a .gz
+    # extension. But I still want to be able to use those files
+    print(f'WARNING: Output table {path} wasn\'t actually gzipped, compressing it')
+    tmp_path = path + '.tmp'
+    with open(path, 'rb') as f, gzip.open(tmp_path, 'wb') as g:
+        shutil.copyfileobj(f, g)
+    shutil.move(tmp_path, path)
+
+def complete_gzip_length(path):
+    '''Length of the part of a gzip file made up of complete members,
+    along with the start of its decompressed contents, up to the end of the
+    first line. A run killed in the middle of an append leaves an incomplete
+    member at the end, which makes the whole file unreadable'''
+    complete_length = 0
+    position = 0
+    head = b''
+    decompressor = zlib.decompressobj(wbits=31)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            while chunk:
+                try:
+                    out = decompressor.decompress(chunk)
+                except zlib.error:
+                    return complete_length, head
+                if b'\n' not in head:
+                    head += out
+                if decompressor.eof:
+                    # Anything after the end of this member is the start of
+                    # the next one
+                    position += len(chunk) - len(decompressor.unused_data)
+                    complete_length = position
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+                else:
+                    position += len(chunk)
+                    chunk = b''
+    return complete_length, head
+
+def repair_table(path, columns):
+    '''Make sure a gzipped CSV file that rows will be appended to can be
+    read: cut off an incomplete gzip member left at the end by a killed run,
+    and add the header if the file doesn't have one'''
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    complete_length, head = complete_gzip_length(path)
+    if complete_length < os.path.getsize(path):
+        print(f'WARNING: Output table {path} ends with an incomplete write, probably from a run that was killed. Removing it')
+        os.truncate(path, complete_length)
+    header = ','.join(columns)
+    first_line = head.split(b'\n', 1)[0].rstrip(b'\r').decode('utf-8')
+    if first_line == header:
+        return
+    elif first_line != '':
+        raise ValueError(f'Output table {path} has header {first_line}, expected {header}')
+    # An earlier version wrote a table with no rows as just a blank line. Rows
+    # appended after that have no header, so replace the blank lines at the
+    # start with one
+    print(f'WARNING: Output table {path} has no header, adding it')
+    tmp_path = path + '.tmp'
+    with gzip.open(path, 'rb') as f, \
+            gzip.open(tmp_path, 'wb', compresslevel=1) as g:
+        g.write(header.encode('utf-8') + b'\n')
+        for line in f:
+            if line.strip():
+                g.write(line)
+                break
+        shutil.copyfileobj(f, g)
+    shutil.move(tmp_path, path)
+
+def append_table(table_cols, outpath):
+    '''Append rows, given as a dictionary of columns, to a gzipped CSV
+    file. The header is written only if the file is new or empty. Each call
+    adds a gzip member to the file. If the run is killed partway through
+    writing it, repair_table removes it on the next run'''
+    table = pd.DataFrame(table_cols)
+    write_header = not os.path.exists(outpath) or os.path.getsize(outpath) == 0
+    if len(table) == 0 and not write_header:
+        return
+    # Using the fastest gzip level; the default level 9 is several times
+    # slower for little benefit
+    with gzip.open(outpath, 'at', compresslevel=1, newline='') as f:
+        table.to_csv(f, header=write_header, index=False)
+
+def read_completed(completed_path, diagram_path):
+    '''Read the set of chemsys's listed in a text file of completed
+    chemsys's, or, if there isn't one, the chemsys's in the corresponding
+    diagram table'''
+    try:
+        with open(completed_path, 'r') as f:
+            return set(line.rstrip('\n') for line in f)
+    except FileNotFoundError:
+        pass
+    try:
+        old_diagram_tbl = pd.read_csv(diagram_path, usecols=['symbols'])
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return set()
+    return set(old_diagram_tbl['symbols'].tolist())
+
+def safeint(r, tol=1e-5):
+    '''Safe conversion to an integer. Rounds to the nearest integer rather
+    than truncating, so that values just below an integer are accepted'''
+    n = round(r)
+    if abs(n - r) > tol:
         raise ValueError(f'Value {r} is not close to an integer')
     return n
 
@@ -119,212 +156,533 @@ def json2pourbaix(json_text):
     outlist = json.loads(json_text, cls=MontyDecoder)
     return outlist
 
-def string2job(instr, njobs):
-    '''Given a string, determine the job number of the job that will process
-    that string'''
-    hashed = md5(instr.encode('utf-8')).hexdigest()
-    return int(hashed, 16) % njobs
-
-# Rows for an output table of elements entries and energies
-data_tbl_rows = []
-
-# Pourbaix diagram construction information rows
-diagram_tbl_rows = []
-
-intbl_path = 'pourbaix_downloads.csv.gz'
-# Header row:
-# symbols,n_entries,download_time,entries_outpath,error
-intypes = {
-        'symbols': str,
-        'n_entries': 'Int64',          # nullable integer
-        'download_time': float,        # always float
-        'entries_outpath': str,
-        'error': str
-    }
-intbl = pd.read_csv(intbl_path, dtype=intypes)
-
-# Sort the table so that the faster diagrams will run first
-intbl = intbl.sort_values(by='n_entries')
-
-# Decide names of output files
-if job_number is not None:
-    # Save the data for this job to a file
-    diagram_outpath = f'pourbaix_diagrams_{job_number}.csv.gz'
-    data_outpath = f'pourbaix_data_{job_number}.csv.gz'
-else:
-    diagram_outpath = 'pourbaix_diagrams.csv.gz'
-    data_outpath = 'pourbaix_data.csv.gz'
-
-# If the output files are already there, read them. Otherwise, create empty
-# tables
-try:
-    # I messed up a run and didn't save as gzip, but did save with a .gz
-    # extension. But I still want to be able to read those files
-    try:
-        old_diagram_tbl = pd.read_csv(diagram_outpath)
-    except BadGzipFile:
-        print(f'WARNING: Input table {diagram_outpath} wasn\'t actually gzipped')
-        old_diagram_tbl = pd.read_csv(diagram_outpath, compression = None)
-    prev_symbols = set(old_diagram_tbl['symbols'].tolist())
-except (FileNotFoundError, pd.errors.EmptyDataError):
-    old_diagram_tbl = pd.DataFrame()
+def load_pourbaix_entries(inpath):
+    '''Load the list of PourbaixEntry objects saved during download. Decoding
+    the JSON is slow, so the decoded list is also pickled next to the JSON
+    file, and the pickle is used instead if it's there and at least as new as
+    the JSON file'''
+    pkl_path = inpath + '.pkl'
+    # The JSON file is overwritten if the chemsys is downloaded again, in
+    # which case the pickle is out of date and has to be made again
+    if os.path.exists(pkl_path) \
+            and os.path.getmtime(pkl_path) >= os.path.getmtime(inpath):
+        with open(pkl_path, 'rb') as f:
+            return pickle.load(f)
+    # Decompress the whole file in one call, rather than streaming it through
+    # GzipFile in small chunks
+    with open(inpath, 'rb') as f:
+        json_text = gzip.decompress(f.read()).decode('utf-8')
+    pourbaix_entries = json2pourbaix(json_text)
+    # Write to a temporary file first so that an interrupted write doesn't
+    # leave behind a truncated pickle
+    tmp_pkl_path = pkl_path + '.tmp'
+    with open(tmp_pkl_path, 'wb') as f:
+        pickle.dump(pourbaix_entries, f, protocol=5)
+    shutil.move(tmp_pkl_path, pkl_path)
+    return pourbaix_entries
+
+def assign_jobs(costs, njobs):
+    '''Given a dictionary from chemsys to an estimate of the cost of
+    processing it, determine the job number of the job that will process each
+    chemsys. Uses longest-processing-time-first scheduling: going from the most
+    to the least expensive, each chemsys goes to the job with the least total
+    cost so far. Ties are broken by chemsys and by job number, so that every
+    job computes the same assignment'''
+    # Heap of (total cost, job number) pairs, so the least loaded job is first
+    loads = [(0, job) for job in range(njobs)]
+    assignment = dict()
+    for chemsys in sorted(costs, key=lambda chemsys: (-costs[chemsys], chemsys)):
+        load, job = heapq.heappop(loads)
+        assignment[chemsys] = job
+        heapq.heappush(loads, (load + costs[chemsys], job))
+    return assignment
+
+def construct_pourbaix_diagram(pourbaix_entries, normalized_composition,
+                               profile=False):
+    '''Construct the Pourbaix diagram for one composition from the entries of
+    a chemsys. Returns the diagram and the time taken to construct it, which
+    is NaN unless profile is true'''
+    # Time construction of the diagram since I'm not sure if
+    # it's fast
+    if profile:
+        diagram_time_start = time()
+
+    # Construct the Pourbaix diagram
+    pourbaix_diagram = PourbaixDiagram(
+        entries=pourbaix_entries,
+    # PourbaixDiagram documentation:
+    # https://pymatgen.org/pymatgen.analysis.html#pymatgen.analysis.pourbaix_diagram.PourbaixDiagram
+    # Says of "filter_solids" that it "generally leads to the
+    # most accurate Pourbaix diagrams"
+        filter_solids=True,
+        comp_dict=normalized_composition)
+
+    if profile:
+        diagram_time = time() - diagram_time_start
+    else:
+        diagram_time = float('nan')
+
+    return pourbaix_diagram, diagram_time
+
+# Entries of the chemsys being processed, in a diagram construction worker
+worker_pourbaix_entries = None
+
+def init_diagram_worker(pourbaix_entries):
+    '''Initializer for the diagram construction workers. The entries are
+    the same for every composition of a chemsys, so they're given to each
+    worker once, rather than sent again with every composition'''
+    global worker_pourbaix_entries
+    worker_pourbaix_entries = pourbaix_entries
+
+def construct_worker_pourbaix_diagram(normalized_composition, profile=False):
+    '''Construct a Pourbaix diagram in a diagram construction worker, from
+    the entries it was initialized with'''
+    return construct_pourbaix_diagram(worker_pourbaix_entries,
+                                      normalized_composition, profile)
+
+worker_options = None
+
+def init_chemsys_worker(options):
+    '''Initializer for the chemsys workers. The conditions and other options
+    are the same for every chemsys, so they're given to each worker once,
+    rather than sent again with every chemsys'''
+    global worker_options
+    worker_options = options
+
+def process_worker_chemsys(task):
+    '''Process a chemsys in a chemsys worker, with the options it was
+    initialized with'''
+    return process_chemsys(task, **worker_options)
+
+def process_chemsys(task, global_conditions, material_conditions,
+                    profile=False, diagram_processes=1):
+    '''Compute decomposition energies for every solid entry of one chemsys.
+    The task is a (chemsys, path to saved entries) pair. Returns the columns
+    for the diagram table and the columns for the data table. This is
+    run in worker processes, so it shouldn't touch any output files. Diagram
+    construction and energy lookups are only timed if profile is true;
+    otherwise the timing columns are NaN. If diagram_processes is more than
+    one, the diagrams for different compositions are constructed in a pool
+    of that many processes'''
+    chemsys, inpath = task
+
+    # Columns of an output table of elements entries and energies
+    data_tbl_cols = {column: [] for column in DATA_COLUMNS}
+    # Pourbaix diagram construction information columns
+    diagram_tbl_cols = {column: [] for column in DIAGRAM_COLUMNS}
+
+    # Separate the elements in the chemsys into a list
+    current_symbols = chemsys.split('-')
+    # And a set, for checking membership
+    current_symbols_set = set(current_symbols)
+
+    # Create a list of PourbaixEntry objects from text saved during download
+    pourbaix_entries = load_pourbaix_entries(inpath)
+
+    solid_entries = [entry \
+                     for entry in pourbaix_entries \
+                     if entry.phase_type == 'Solid']
+
+    # First pass over the entries: work out the conditions and the
+    # composition of each entry, and collect the compositions for which a
+    # Pourbaix diagram will be needed
+    # Entries to look up, as (entry, partial row, conditions, composition)
+    entry_lookups = []
+    # Compositions needing a diagram, each with its normalized composition and
+    # the partial row of the first entry that needed it, for the diagram table
+    diagram_compositions = dict()
+    # Metal-only compositions of the entries, keyed by the full composition
+    metal_compositions = dict()
+    # The chemsys in the form used in the output tables, which is the same
+    # for every entry
+    sorted_chemsys = '-'.join(sorted(current_symbols))
+    for pourbaix_entry in solid_entries:
+        material_id_match = ENTRY_ID_REGEX.match(pourbaix_entry.entry_id)
+        if material_id_match is not None:
+            material_id = material_id_match.group(0)
+        else:
+            raise ValueError(f'Invalid entry_id format: {pourbaix_entry.entry_id}')
+        # The conditions are the global conditions, plus the
+        # material-specific conditions, if any
+        conditions = global_conditions + material_conditions.get(material_id, [])
+
+        # If there's no conditions to check, we can skip this one. Checking
+        # before anything else, since with only material-specific conditions
+        # most entries get skipped
+        if len(conditions) == 0:
+            continue
+
+        partial_row = dict()
+        partial_row['symbols'] = sorted_chemsys
+        partial_row['name'] = pourbaix_entry.name
+        partial_row['entry_id'] = pourbaix_entry.entry_id
+
+        # Determine the composition of the entry, including only the metal
+        # atoms, and create a dictionary of normalized fractions for
+        # creating a temporary Pourbaix diagram
+        # Using integers for hashability
+        # Polymorphs share a composition, so only reduce each one once
+        entry_composition = pourbaix_entry.composition
+        try:
+            unnormalized_composition = metal_compositions[entry_composition]
+        except KeyError:
+            unnormalized_composition = \
+                    {key.symbol: safeint(value)
+                     for key, value in entry_composition.reduced_composition.items() \
+                     if key.symbol in current_symbols_set}
+            metal_compositions[entry_composition] = unnormalized_composition
+        composition_total = sum(unnormalized_composition.values())
+        normalized_composition = \
+                {key: value / composition_total \
+                 for key, value in unnormalized_composition.items()}
+        # Probably better to use it without normalization. A sorted tuple is
+        # cheaper to build and hash than a frozenset
+        hashable_composition = \
+                tuple(sorted(unnormalized_composition.items()))
+        if hashable_composition not in diagram_compositions:
+            diagram_compositions[hashable_composition] = \
+                    (normalized_composition, partial_row)
+        entry_lookups.append(
+                (pourbaix_entry, partial_row, conditions, hashable_composition))
+
+    # Construct a temporary Pourbaix diagram for each composition, once.
+    # These are independent of each other, so they can be constructed in
+    # parallel
+    if diagram_processes > 1 and len(diagram_compositions) > 1:
+        max_workers = min(diagram_processes, len(diagram_compositions))
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=init_diagram_worker,
+                                 initargs=(pourbaix_entries,)) as executor:
+            futures = {hashable_composition:
+                       executor.submit(construct_worker_pourbaix_diagram,
+                                       normalized_composition, profile)
+                       for hashable_composition, (normalized_composition, partial_row) \
+                       in diagram_compositions.items()}
+            constructed_diagrams = {hashable_composition: future.result()
+                                    for hashable_composition, future \
+                                    in futures.items()}
+    else:
+        constructed_diagrams = {hashable_composition:
+                                construct_pourbaix_diagram(
+                                    pourbaix_entries, normalized_composition,
+                                    profile)
+                                for hashable_composition, (normalized_composition, partial_row) \
+                                in diagram_compositions.items()}
+
+    pourbaix_diagrams = dict()
+    for hashable_composition, (normalized_composition, partial_row) \
+            in diagram_compositions.items():
+        pourbaix_diagram, diagram_time = constructed_diagrams[hashable_composition]
+        pourbaix_diagrams[hashable_composition] = pourbaix_diagram
+
+        # Save the timing information to an output table
+        for key, value in partial_row.items():
+            diagram_tbl_cols[key].append(value)
+        diagram_tbl_cols['diagram_time'].append(diagram_time)
+
+    # Second pass over the entries: look up the decomposition energies
+    for pourbaix_entry, partial_row, conditions, hashable_composition \
+            in entry_lookups:
+        pourbaix_diagram = pourbaix_diagrams[hashable_composition]
+        # get_decomposition_energy is vectorized over pH and voltage, so
+        # look up all the conditions in one call
+        ph_array = np.array([pH for pH, V in conditions])
+        voltage_array = np.array([V for pH, V in conditions])
+        # I'm sure the lookup time is short, but timing it just in case
+        if profile:
+            lookup_start = time()
+        energies = pourbaix_diagram.get_decomposition_energy(
+                pourbaix_entry, ph_array, voltage_array)
+        if profile:
+            # Report the time per condition, as it was when they were looked
+            # up one at a time
+            lookup_time = (time() - lookup_start) / len(conditions)
+        else:
+            lookup_time = float('nan')
+
+        # Save the data for this entry and each of the conditions
+        n_conditions = len(conditions)
+        for key, value in partial_row.items():
+            data_tbl_cols[key].extend([value] * n_conditions)
+        data_tbl_cols['ph'].extend(ph_array)
+        data_tbl_cols['voltage'].extend(voltage_array)
+        data_tbl_cols['decomposition_energy'].extend(energies)
+        data_tbl_cols['decomposition_energy_lookup_time'].extend(
+                [lookup_time] * n_conditions)
+
+    return diagram_tbl_cols, data_tbl_cols
+
+def main():
+    parser = argparse.ArgumentParser(description='Decomposition energies from a Pourbaix diagram.')
+
+    parser.add_argument('-j', '--job-number', type=int, default=None,
+                        help='Job number for parallel runs (starting from 0)')
+    parser.add_argument('-n', '--njobs', type=int, default=None,
+                        help='Total number of parallel jobs')
+    parser.add_argument('-P', '--processes', type=int, default=1,
+                        help='Number of worker processes within this job')
+    parser.add_argument('-D', '--diagram-processes', type=int, default=1,
+                        help='Number of worker processes for constructing the diagrams of a single element combination')
+    parser.add_argument('--pin-cpus', action='store_true',
+                        help='Pin each job to its own share of the available CPUs, for parallel jobs on the same node')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record the time taken to construct each diagram and look up each energy')
+
+    # Optional global conditions CSV
+    parser.add_argument('-g', '--global-conditions', type=str, default=None,
+                        help='Path to CSV file with columns ph,voltage for global conditions')
+
+    # Optional material-specific conditions CSV
+    parser.add_argument('-m', '--material-conditions', type=str, default=None,
+                        help='Path CSV file with columns material_id,ph,voltage for material-specific conditions')
+
+    # Optional direct conditions from command line
+    parser.add_argument('-p', '--ph', type=str, default=None,
+                        help='Single or comma-separated pH values')
+    parser.add_argument('-v', '--voltage', type=str, default=None,
+                        help='Single comma-separated voltage values (Cartesian product with pH values will be used)')
+
+    args = parser.parse_args()
+
+    # Initialize empty data structures to hold conditions
+    global_conditions = []
+    material_conditions = dict()
+
+    # Check at least one condition source is provided
+    if not (args.global_conditions is not None or
+            args.material_conditions is not None or
+            (args.ph is not None and args.voltage is not None)):
+        raise ValueError('You must specify at least one method for conditions: global file, material-specific file, or direct --ph and --voltage arguments.')
+
+    # Read global conditions file if provided
+    if args.global_conditions is not None:
+        global_df = pd.read_csv(args.global_conditions)
+        global_cols = set(global_df.columns)
+        if 'ph' not in global_cols or 'voltage' not in global_cols:
+            raise ValueError('Global conditions file must have columns "ph" and "voltage".')
+        global_conditions.extend(zip(global_df.ph, global_df.voltage))
+
+    # Add Cartesian product of conditions directly from the command line if provided
+    if (args.ph is not None) and (args.voltage is not None):
+        ph_list = [float(p) for p in args.ph.split(',')]
+        voltage_list = [float(v) for v in args.voltage.split(',')]
+        global_conditions.extend(itertools.product(ph_list, voltage_list))
+    elif (args.ph is not None) or (args.voltage is not None):
+        raise ValueError('You must specify both --ph and --voltage if specifying conditions directly.')
+
+    # Read material-specific conditions file if provided
+    if args.material_conditions:
+        material_df = pd.read_csv(args.material_conditions)
+        material_cols = set(material_df.columns)
+        if 'material_id' not in material_cols or 'ph' not in material_cols or 'voltage' not in material_cols:
+            raise ValueError('Material conditions file must have columns "material_id", "ph", and "voltage".')
+        for material_id, df in material_df.groupby('material_id'):
+            if material_id not in material_conditions:
+                material_conditions[material_id] = []
+            material_conditions[material_id].extend(zip(df.ph, df.voltage))
+
+    # Optional argument to split into jobs
+    if (args.job_number is None) != (args.njobs is None):
+        raise ValueError('You must specify both --job-number and --njobs, or neither.')
+
+    if args.job_number is None:
+        job_number = None
+        njobs = None
+    else:
+        if args.job_number < 0 or args.job_number >= args.njobs:
+            raise ValueError('job-number must be in range [0, njobs - 1]')
+        print(f'Running job number {args.job_number} of {args.njobs} jobs')
+        job_number = args.job_number
+        njobs = args.njobs
+
+    if args.processes < 1:
+        raise ValueError('processes must be at least 1')
+    if args.diagram_processes < 1:
+        raise ValueError('diagram-processes must be at least 1')
+    # Workers in a multiprocessing pool aren't allowed to start processes of
+    # their own
+    if args.processes > 1 and args.diagram_processes > 1:
+        raise ValueError('Use either --processes or --diagram-processes, not both')
+
+    # When several jobs run on the same node, give each job its own CPUs, so
+    # they don't compete for the same cores. Worker processes inherit this
+    if args.pin_cpus:
+        if job_number is None:
+            raise ValueError('--pin-cpus requires --job-number and --njobs')
+        if not hasattr(os, 'sched_setaffinity'):
+            raise ValueError('--pin-cpus is not supported on this platform')
+        cpus = sorted(os.sched_getaffinity(0))
+        job_cpus = cpus[job_number::njobs]
+        if len(job_cpus) == 0:
+            raise ValueError(f'Not enough CPUs ({len(cpus)}) to give one to each of {njobs} jobs')
+        os.sched_setaffinity(0, job_cpus)
+        print(f'Pinned job {job_number} to CPUs {job_cpus}')
+
+    intbl_path = 'pourbaix_downloads.csv.gz'
+    # Header row:
+    # symbols,n_entries,download_time,entries_outpath,error
+    # The table is only read row by row, so the csv module is enough. Missing
+    # values are read as empty strings
+    with gzip.open(intbl_path, 'rt', newline='') as f:
+        intbl_rows = list(csv.DictReader(f))
+
+    # Decide names of output files
+    if job_number is not None:
+        # Save the data for this job to a file
+        diagram_outpath = f'pourbaix_diagrams_{job_number}.csv.gz'
+        data_outpath = f'pourbaix_data_{job_number}.csv.gz'
+        completed_outpath = f'pourbaix_completed_{job_number}.txt'
+    else:
+        diagram_outpath = 'pourbaix_diagrams.csv.gz'
+        data_outpath = 'pourbaix_data.csv.gz'
+        completed_outpath = 'pourbaix_completed.txt'
+
+    # Rows are appended to the output files as each chemsys finishes, so make
+    # sure they're gzipped and readable, and that they have a header even if
+    # this job ends up with nothing to do
+    for outpath, columns in [(data_outpath, DATA_COLUMNS),
+                             (diagram_outpath, DIAGRAM_COLUMNS)]:
+        ensure_gzipped(outpath)
+        repair_table(outpath, columns)
+        append_table({column: [] for column in columns}, outpath)
+
+    # Chemsys's already processed in a previous run are the ones in the
+    # diagram tables. They're also listed one per line in a small text file
+    # for each table, so that resuming doesn't require parsing the whole
+    # diagram tables
+    # If this job's text file is missing, it's output from before the text
+    # file was introduced, or a new run, so make it from the diagram table
+    # Written to a temporary file first, and only read from the diagram table
+    # before anything is written, so that an interrupted write doesn't leave
+    # behind an empty or partial list
+    if not os.path.exists(completed_outpath):
+        done = read_completed(completed_outpath, diagram_outpath)
+        tmp_completed_outpath = completed_outpath + '.tmp'
+        with open(tmp_completed_outpath, 'w') as f:
+            f.writelines(f'{chemsys}\n' for chemsys in sorted(done))
+        shutil.move(tmp_completed_outpath, completed_outpath)
+    # It's important to check the output of every job, not just this one.
+    # Which job a chemsys is assigned to depends on the whole downloads table,
+    # so if the number of jobs or the downloads table changed, this job's
+    # chemsys's may already have been done by a different job
+    # Glob captures numbered output (where * is "_[number]") and un-numbered
+    # output (where * is empty)
     prev_symbols = set()
-try:
-    try:
-        old_data_tbl = pd.read_csv(data_outpath)
-    except BadGzipFile:
-        print(f'WARNING: Input table {data_outpath} wasn\'t actually gzipped')
-        old_data_tbl = pd.read_csv(data_outpath, compression = None)
-except (FileNotFoundError, pd.errors.EmptyDataError):
-    old_data_tbl = pd.DataFrame()
-
-try:
-    # Time between writes to disk
-    write_start_time = time()
-    for i, row in enumerate(intbl.itertuples()):
+    for this_diagram_path in glob('pourbaix_diagrams*.csv.gz'):
+        this_completed_path = this_diagram_path \
+                .replace('pourbaix_diagrams', 'pourbaix_completed') \
+                .replace('.csv.gz', '.txt')
+        prev_symbols.update(read_completed(this_completed_path, this_diagram_path))
+
+    # Collect the chemsys's that have entries to process
+    valid_rows = []
+    valid_symbols = set()
+    for row in intbl_rows:
         # The data from the table that I'm going to use
-        inpath = row.entries_outpath
-        chemsys = row.symbols
+        inpath = row['entries_outpath']
+        chemsys = row['symbols']
 
         # The chemsys's that couldn't be downloaded because the data is
         # unavailable are still recorded in the table to avoid retrying the
         # download. These will be recognizable because the path to the entry
         # will be missing. If this is the case, skip this iteration of the loop
-        if pd.isna(inpath):
+        if not inpath:
             continue
         # Also check directly that the chemsys is nonempty. There should never
         # be a circumstance where the input path is present but the chemsys is
         # missing. However, in older versions of the code, systems with only H
         # and O would still be considered, but with an empty chemsys. So just
-        # check that it isn't missing or the empty string. May as well leave
+        # check that it isn't the empty string. May as well leave
         # the check in, because even though it isn't intended behavior, it's
         # safer to handle invalid rows by skipping them, since they don't
         # undermine the validity of the rest of the rows. But since it does
         # mean the input is invalid, output a warning
-        if pd.isna(chemsys) or chemsys == '':
+        if chemsys == '':
             print(f'WARNING: file {inpath} has an empty chemsys. Skipping')
             continue
-
-        # Skip if this one has been downloaded already
+        # If the download tables from overlapping runs were concatenated, the
+        # same chemsys can appear more than once. The entries are saved to the
+        # same path either way, so only process it once
+        if chemsys in valid_symbols:
+            print(f'Skipping duplicate row for {chemsys}')
+            continue
+        valid_symbols.add(chemsys)
+
+        # Older versions of the downloader wrote the number of entries as a
+        # float
+        n_entries = int(float(row['n_entries'])) if row['n_entries'] else 0
+        valid_rows.append((chemsys, inpath, n_entries))
+
+    # Sort the rows so that the faster diagrams will run first
+    valid_rows.sort(key=lambda row: row[2])
+
+    # Split the chemsys's between jobs, balancing the number of entries, as a
+    # rough estimate of the cost of constructing the diagrams. This has to be
+    # based only on the input table, and not on timings from previous runs,
+    # since jobs running at the same time have to agree on the assignment
+    if job_number is not None:
+        costs = {chemsys: n_entries
+                 for chemsys, inpath, n_entries in valid_rows}
+        chemsys_to_job = assign_jobs(costs, njobs)
+
+    # Decide which chemsys's this job will process, in the parent process,
+    # so that the workers only receive work that actually needs doing
+    tasks = []
+    for chemsys, inpath, n_entries in valid_rows:
+        # Skip if this one has been processed already
         if chemsys in prev_symbols:
-            print(f'Skipping {chemsys} because it has been downloaded already')
+            print(f'Skipping {chemsys} because it has been processed already')
             continue
 
-        # Separate the elements in the chemsys into a list
-        current_symbols = chemsys.split('-')
-
         # Skip if this chemsys is a part of this job
         if job_number is not None:
-            # Get the job number for this chemsys
-            chemsys_job_number = string2job(chemsys, njobs)
-            if chemsys_job_number != job_number:
+            if chemsys_to_job[chemsys] != job_number:
                 continue
 
-        # Create a list of PourbaixEntry objects from text saved during download
-        json_text = gzip.open(inpath, 'rt').read()
-        pourbaix_entries = json2pourbaix(json_text)
-
-        solid_entries = [entry \
-                         for entry in pourbaix_entries \
-                         if entry.phase_type == 'Solid']
-
-        # Precomputed Pourbaix diagrams
-        # These are created inside the loop because they're based on the list
-        # of entries retrieved
-        pourbaix_diagrams = dict()
-        for pourbaix_entry in solid_entries:
-            partial_row = dict()
-            chemsys = '-'.join(sorted(current_symbols))
-            partial_row['symbols'] = chemsys
-            partial_row['name'] = pourbaix_entry.name
-            partial_row['entry_id'] = pourbaix_entry.entry_id
-
-            # The conditions are the global conditions, plus the
-            # material-specific conditions, if any
-            conditions = global_conditions.copy()
-            material_id_match = re.match(r'^(mp|mvc)-\d+', pourbaix_entry.entry_id)
-            if material_id_match is not None:
-                material_id = material_id_match.group(0)
-            else:
-                raise ValueError(f'Invalid entry_id format: {pourbaix_entry.entry_id}')
-            if material_id in material_conditions.keys():
-                conditions.extend(material_conditions[material_id])
-
-            # If there's no conditions to check, we can skip this one
-            if len(conditions) == 0:
-                continue
+        tasks.append((chemsys, inpath))
+
+    chemsys_options = dict(global_conditions=global_conditions,
+                           material_conditions=material_conditions,
+                           profile=args.profile,
+                           diagram_processes=args.diagram_processes)
+    # With a single process, skip the pool entirely
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes,
+                                    initializer=init_chemsys_worker,
+                                    initargs=(chemsys_options,))
+        # Unordered, so that a fast chemsys doesn't wait on a slow one before
+        # its results get written. Chunks of one, since a single diagram can
+        # take a long time and I'd rather not have one worker sitting on a
+        # backlog while the others are idle
+        results = pool.imap_unordered(process_worker_chemsys, tasks, chunksize=1)
+    else:
+        pool = None
+        init_chemsys_worker(chemsys_options)
+        results = map(process_worker_chemsys, tasks)
 
-            # Determine the composition of the entry, including only the metal
-            # atoms, and create a dictionary of normalized fractions for
-            # creating a temporary Pourbaix diagram
-            # Using integers for hashability
-            unnormalized_composition = \
-                    {key.symbol: safeint(value)
-                     for key, value in pourbaix_entry.composition.reduced_composition.items() \
-                     if key.symbol in current_symbols}
-            composition_total = sum(unnormalized_composition.values())
-            normalized_composition = \
-                    {key: value / composition_total \
-                     for key, value in unnormalized_composition.items()}
-            # Probably better to use it without normalization
-            hashable_composition = \
-                    frozenset(unnormalized_composition.items())
-            # Create a temporary Pourbaix diagram with the correct composition
-            try:
-                pourbaix_diagram = pourbaix_diagrams[hashable_composition]
-            except KeyError:
-                # Time construction of the diagram since I'm not sure if
-                # it's fast
-                diagram_time_start = time()
-
-                # Construct the Pourbaix diagram
-                pourbaix_diagram = PourbaixDiagram(
-                    entries=pourbaix_entries,
-                # PourbaixDiagram documentation:
-                # https://pymatgen.org/pymatgen.analysis.html#pymatgen.analysis.pourbaix_diagram.PourbaixDiagram
-                # Says of "filter_solids" that it "generally leads to the
-                # most accurate Pourbaix diagrams"
-                    filter_solids=True,
-                    comp_dict=normalized_composition)
-
-                diagram_time_end = time()
-
-                # Save the diagram so that I don't have to construct it
-                # again for the same composition
-                pourbaix_diagrams[hashable_composition] = pourbaix_diagram
-
-                # Save the timing information to an output table
-                diagram_time = diagram_time_end - diagram_time_start
-                this_diagram_tbl_row = partial_row.copy()
-                this_diagram_tbl_row['diagram_time'] = diagram_time
-                diagram_tbl_rows.append(this_diagram_tbl_row)
-            # Looping over pH, voltage pairs
-            for pH, V in conditions:
-                # I'm sure the lookup time is short, but timing it just in case
-                lookup_start = time()
-                energy = pourbaix_diagram.get_decomposition_energy(pourbaix_entry, pH, V)
-                lookup_end = time()
-                lookup_time = lookup_end - lookup_start
-
-                # Save the data for this entry and conditions
-                this_data_row = partial_row.copy()
-                this_data_row['ph'] = pH
-                this_data_row['voltage'] = V
-                this_data_row['decomposition_energy'] = energy
-                this_data_row['decomposition_energy_lookup_time'] = lookup_time
-
-                data_tbl_rows.append(this_data_row)
-        # Write the output file to disk
-        buffer_size = 1
-        if i % buffer_size == 0:
+    try:
+        # Time between writes to disk
+        write_start_time = time()
+        for these_diagram_cols, these_data_cols in results:
             write_end_time = time()
             time_since_last_write = write_end_time - write_start_time # seconds
             minutes_since_last_write = time_since_last_write / 60
-            print(f'Processed {buffer_size} element combinations in {minutes_since_last_write:.2f} minutes, writing to disk')
-            finish(data_tbl_rows, diagram_tbl_rows, old_data_tbl, old_diagram_tbl,
-                   data_outpath, diagram_outpath)
+            print(f'Processed 1 element combination in {minutes_since_last_write:.2f} minutes, writing to disk')
+            # Write the data before the diagrams, and the diagrams before the
+            # list of completed chemsys's, since the diagram table and the
+            # list record which chemsys's are done
+            append_table(these_data_cols, data_outpath)
+            append_table(these_diagram_cols, diagram_outpath)
+            with open(completed_outpath, 'a') as f:
+                f.writelines(f'{chemsys}\n'
+                             for chemsys in set(these_diagram_cols['symbols']))
             write_start_time = time()
-finally:
-    print(f'Finished, writing to disk')
-    finish(data_tbl_rows, diagram_tbl_rows, old_data_tbl, old_diagram_tbl,
-           data_outpath, diagram_outpath)
+    finally:
+        # Results are written as they arrive, so all that's left is to stop
+        # the workers
+        if pool is not None:
+            pool.terminate()
+        print('Finished')
+
+if __name__ == '__main__':
+    main()
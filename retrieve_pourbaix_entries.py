@@ -1,13 +1,24 @@
 '''Retrieve PourbaixEntry objects from the Materials Project, serialize as json, and save as gzipped files, for diagram construction later. Entries are saved to the directory "pourbaix_entries", with filename {chemsys}.json.gz, and can be loaded using pymatgen's MontyDecoder. In addition, a table of data about the downloads is saved, called "pourbaix_downloads.csv.gz". Optionally, a job number and total number of jobs can be specified as arguments, to parallelize the download over multiple invocations of the script. In this case, each will save the json files to the same output folder, but the output table will be "pourbaix_downloads_{job_number}.csv".'''
-import sys
+import argparse
+import fcntl
 from glob import glob
-import functools
-from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from hashlib import blake2b
+from bisect import bisect
+from math import ceil
 import gzip
-from os import mkdir
+import zlib
+import shutil
+from os import mkdir, getpid
+import sqlite3
+import signal
+import socket
+import sys
 import os.path
-import json
-from time import time, sleep
+import queue
+import random
+import threading
+from time import time
 from http.client import IncompleteRead
 from requests.exceptions import (HTTPError, RetryError, ChunkedEncodingError,
                                 ConnectionError, Timeout)
@@ -19,19 +30,59 @@ from mp_api.client import MPRester
 from mp_api.client.core.client import MPRestError
 from monty.json import MontyEncoder
 
+parser = argparse.ArgumentParser(description='Download Pourbaix entries from Materials Project.')
 # Optional argument to split into jobs
-if len(sys.argv) == 1:
+parser.add_argument('job_number', type=int, nargs='?', default=None,
+                    help='Job number for parallel runs (starting from 0)')
+parser.add_argument('njobs', type=int, nargs='?', default=None,
+                    help='Total number of parallel jobs')
+parser.add_argument('-t', '--threads', type=int, default=1,
+                    help='Number of downloads to run at the same time')
+parser.add_argument('-q', '--queue', default=None,
+                    help='SQLite file of chemsys\'s shared between invocations, each of which claims the next chemsys when it has a free thread')
+args = parser.parse_args()
+
+if args.queue is not None and args.job_number is not None:
+    raise ValueError('A job number can\'t be used together with a queue')
+
+if args.job_number is None:
     print('No job number provided, downloading all Pourbaix entries')
     job_number = None
     njobs = None
-if len(sys.argv) == 2:
+elif args.njobs is None:
     raise ValueError('If you provide a job number, you must also provide the total number of jobs')
-if len(sys.argv) == 3:
-    print(f'Running job {sys.argv[1]} of {sys.argv[2]}')
-    job_number = int(sys.argv[1])
-    njobs = int(sys.argv[2])
-if len(sys.argv) > 3:
-    raise ValueError('Too many arguments provided; expected 0 or 2 arguments')
+else:
+    print(f'Running job {args.job_number} of {args.njobs}')
+    job_number = args.job_number
+    njobs = args.njobs
+
+if args.threads < 1:
+    raise ValueError('threads must be at least 1')
+
+# Cluster schedulers send SIGTERM at the end of the walltime. Exit as for an
+# interrupt, so that finished downloads are saved and queue claims released
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+# Claims in the queue older than this are assumed to be from an invocation
+# that was killed, and are released. Longer than the worst case for one
+# chemsys, with every retry backing off as long as possible
+CLAIM_TIMEOUT = 6 * 60 * 60 # seconds
+
+# Columns of the output table, and their types
+DOWNLOAD_COLUMNS = {'symbols': 'string',
+                    'n_entries': 'Int64',
+                    'download_time': 'float64',
+                    'entries_outpath': 'string',
+                    'error': 'string'}
+
+# Encoder for the entries, made once and reused for every chemsys. Only the
+# writer thread uses it
+# The entries are a tree, so skip checking for circular references, and leave
+# out the whitespace between items
+ENTRY_ENCODER = MontyEncoder(check_circular=False, separators=(',', ':'))
+
+# H and O are added to every chemsys when downloading the entries
+HO_SYMBOLS = frozenset(['H', 'O'])
 
 # Directory for saving serialized Pourbaix entries
 outdir = 'pourbaix_entries'
@@ -40,204 +91,618 @@ try:
 except FileExistsError:
     pass
 
+def complete_gzip_length(path):
+    '''Length of the part of a gzip file made up of complete members,
+    along with the start of its decompressed contents, up to the end of the
+    first line. A run killed in the middle of an append leaves an incomplete
+    member at the end, which makes the whole file unreadable'''
+    complete_length = 0
+    position = 0
+    head = b''
+    decompressor = zlib.decompressobj(wbits=31)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            while chunk:
+                try:
+                    out = decompressor.decompress(chunk)
+                except zlib.error:
+                    return complete_length, head
+                if b'\n' not in head:
+                    head += out
+                if decompressor.eof:
+                    # Anything after the end of this member is the start of
+                    # the next one
+                    position += len(chunk) - len(decompressor.unused_data)
+                    complete_length = position
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+                else:
+                    position += len(chunk)
+                    chunk = b''
+    return complete_length, head
+
+def repair_table(path, columns):
+    '''Make sure a gzipped CSV file that rows will be appended to can be
+    read: cut off an incomplete gzip member left at the end by a killed run,
+    and add the header if the file doesn't have one'''
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    complete_length, head = complete_gzip_length(path)
+    if complete_length < os.path.getsize(path):
+        print(f'WARNING: Output table {path} ends with an incomplete write, probably from a run that was killed. Removing it')
+        os.truncate(path, complete_length)
+    header = ','.join(columns)
+    first_line = head.split(b'\n', 1)[0].rstrip(b'\r').decode('utf-8')
+    if first_line == header:
+        return
+    elif first_line != '':
+        raise ValueError(f'Output table {path} has header {first_line}, expected {header}')
+    # An earlier version wrote a table with no rows as just a blank line. Rows
+    # appended after that have no header, so replace the blank lines at the
+    # start with one
+    print(f'WARNING: Output table {path} has no header, adding it')
+    tmp_path = path + '.tmp'
+    with gzip.open(path, 'rb') as f, \
+            gzip.open(tmp_path, 'wb', compresslevel=1) as g:
+        g.write(header.encode('utf-8') + b'\n')
+        for line in f:
+            if line.strip():
+                g.write(line)
+                break
+        shutil.copyfileobj(f, g)
+    shutil.move(tmp_path, path)
+
+def append_table(table_cols, outpath):
+    '''Append rows, given as a dictionary of columns, to a gzipped CSV
+    file. The header is written only if the file is new or empty. Each call
+    adds a gzip member to the file. If the run is killed partway through
+    writing it, repair_table removes it on the next run'''
+    table = pd.DataFrame(table_cols)
+    write_header = not os.path.exists(outpath) or os.path.getsize(outpath) == 0
+    if len(table) == 0 and not write_header:
+        return
+    # Fastest gzip level, like the entries
+    with gzip.open(outpath, 'at', compresslevel=1, newline='') as f:
+        table.to_csv(f, header=write_header, index=False)
+
 # Set the path of the output table containing information about the downloads
 if job_number is None:
     outtbl_path = 'pourbaix_downloads.csv.gz'
 else:
     outtbl_path = f'pourbaix_downloads_{job_number}.csv.gz'
 
-# If it exists already, initialize output table with its data. Otherwise,
-# initialize an empty table
-try:
-    prev_output = pd.read_csv(outtbl_path)
-except (FileNotFoundError, pd.errors.EmptyDataError):
-    prev_output = pd.DataFrame(columns=['symbols', 'n_entries', 'download_time',
-                                        'entries_outpath', 'error'])
-
-# Check if there's already saved output tables from a previous run, and load
-# them if so. It's important to load all output files in case the number of
-# jobs was changed, in which case this job's task may already have been done in
-# a different job number's output file
-# Glob captures numbered output (where * is "_[number]") and un-numbered output
-# (where * is empty)
-prev_output_files = glob('pourbaix_downloads*.csv.gz')
-prev_symbols = set()
-for this_prev_output_file in prev_output_files:
+# Chemsys's in any of the output tables, from every job, are also listed one
+# per line in a small text file, so that starting up doesn't require parsing
+# all the output tables. Jobs lock it while adding to the list or the tables
+downloaded_path = 'pourbaix_downloaded.txt'
+with open(downloaded_path, 'a+') as downloaded_file:
+    fcntl.flock(downloaded_file, fcntl.LOCK_EX)
+    # Rows are appended to the output table, so make sure it's readable first
+    repair_table(outtbl_path, DOWNLOAD_COLUMNS)
+    downloaded_file.seek(0)
+    prev_symbols = set(line.rstrip('\n') for line in downloaded_file)
+    if not prev_symbols:
+        # Output from before the text file was introduced, or a new run
+        # Check if there's already saved output tables from a previous run,
+        # and load them if so. It's important to load all output files in
+        # case the number of jobs was changed, in which case this job's task
+        # may already have been done in a different job number's output file
+        # Glob captures numbered output (where * is "_[number]") and
+        # un-numbered output (where * is empty)
+        prev_output_files = glob('pourbaix_downloads*.csv.gz')
+        for this_prev_output_file in prev_output_files:
+            # Safe to repair other jobs' tables too while holding the lock
+            repair_table(this_prev_output_file, DOWNLOAD_COLUMNS)
+            try:
+                # Only the chemsys's are needed here, so skip parsing the rest
+                this_prev_output = pd.read_csv(this_prev_output_file,
+                        usecols=['symbols'], dtype={'symbols': str})
+                # Set of chemsys's previously downloaded
+                this_prev_symbols = set(this_prev_output['symbols'].tolist())
+                prev_symbols.update(this_prev_symbols)
+            except pd.errors.EmptyDataError:
+                continue
+        downloaded_file.writelines(f'{chemsys}\n' for chemsys in sorted(prev_symbols))
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    '''HTTPAdapter that applies the same timeout to every request sent
+    through it. The MPRester passes its own, shorter, timeout with each
+    request, so a default timeout isn't enough'''
+    def __init__(self, *args, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+def string2position(instr):
+    '''Given a string, determine its position on the hash ring'''
+    # Doesn't need to be a cryptographic hash, just a fast one that's the
+    # same in every run. 64 bits is plenty for the ring
+    hashed = blake2b(instr.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(hashed, 'big')
+
+def assign_jobs(chemsys_list, njobs, vnodes=100, epsilon=0.25):
+    '''Assign each chemsys to a job number by consistent hashing with bounded
+    loads. Each job gets vnodes positions on a hash ring, and a chemsys goes to
+    the first job clockwise from its own position that has fewer than
+    (1+epsilon) times the mean number of chemsys's. Changing the number of jobs
+    only moves a small fraction of chemsys's to a different job, and no job
+    gets far more than its share. Returns a dictionary from chemsys to job
+    number'''
+    ring = sorted((string2position(f'{job}:{vnode}'), job)
+                  for job in range(njobs)
+                  for vnode in range(vnodes))
+    ring_positions = [position for position, job in ring]
+    capacity = ceil((1 + epsilon) * len(chemsys_list) / njobs)
+    loads = [0] * njobs
+    assignments = dict()
+    # Every job has to come up with the same assignments, so go through the
+    # chemsys's in the same order in each
+    for chemsys in sorted(chemsys_list):
+        i = bisect(ring_positions, string2position(chemsys))
+        while True:
+            position, job = ring[i % len(ring)]
+            if loads[job] < capacity:
+                break
+            i += 1
+        loads[job] += 1
+        assignments[chemsys] = job
+    return assignments
+
+def owner_is_alive(owner):
+    '''Whether the invocation that made a claim in the queue may still be
+    running. Only invocations on this host can be checked; for others, this
+    is always True'''
+    host, _, pid = str(owner).rpartition(':')
+    if host != socket.gethostname():
+        return True
     try:
-        this_prev_output = pd.read_csv(this_prev_output_file)
-        # Set of chemsys's previously downloaded
-        this_prev_symbols = set(this_prev_output['symbols'].tolist())
-        prev_symbols.update(this_prev_symbols)
-    except pd.errors.EmptyDataError:
-        continue
-
-def pourbaix2json(pourbaix_entries):
-    '''Convert a list of entry objects to text'''
-    # Use the Monty encoder to convert to a json string
-    text = json.dumps(pourbaix_entries, cls=MontyEncoder)
-    return text
-
-def string2job(instr, njobs):
-    '''Given a string, determine the job number of the job that will process
-    that string'''
-    hashed = md5(instr.encode('utf-8')).hexdigest()
-    return int(hashed, 16) % njobs
-
-# Download information rows
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists, but belongs to someone else
+        return True
+    return True
+
+def release_stale_claims(conn):
+    '''Put chemsys's claimed by invocations that were killed without
+    releasing their claims back in the queue. A claim is stale if the
+    invocation was on this host and is no longer running, or if it was made
+    longer ago than any download should take. Must be called inside a
+    transaction'''
+    stale_before = time() - CLAIM_TIMEOUT
+    claims = conn.execute('SELECT chemsys, owner, claimed_at FROM tasks '
+                          'WHERE status = \'in_progress\'').fetchall()
+    stale = [chemsys for chemsys, claim_owner, claimed_at in claims
+             if claimed_at is None or claimed_at < stale_before
+             or not owner_is_alive(claim_owner)]
+    for chemsys in stale:
+        print(f'Releasing stale claim on {chemsys}')
+    set_task_status(conn, stale, 'pending')
+
+def init_queue(queue_path, chemsys_list, done_chemsys):
+    '''Connect to the queue of chemsys's shared between invocations, creating
+    it if this is the first. Chemsys's that aren't in the queue yet are added
+    as pending, ones already downloaded are marked done, and stale claims are
+    released'''
+    # Other invocations may hold the lock for a while when they start up
+    conn = sqlite3.connect(queue_path, timeout=600, isolation_level=None)
+    # BEGIN IMMEDIATE takes the write lock, so only one invocation sets up
+    # the queue at a time
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('CREATE TABLE IF NOT EXISTS tasks('
+                 'chemsys TEXT PRIMARY KEY, status TEXT, owner TEXT, claimed_at REAL)')
+    conn.executemany('INSERT OR IGNORE INTO tasks(chemsys, status) VALUES (?, \'pending\')',
+                     [(chemsys,) for chemsys in chemsys_list])
+    conn.executemany('UPDATE tasks SET status = \'done\' WHERE chemsys = ?',
+                     [(chemsys,) for chemsys in done_chemsys])
+    release_stale_claims(conn)
+    conn.execute('COMMIT')
+    return conn
+
+def claim_task(conn, owner):
+    '''Claim the next pending chemsys in the queue for this invocation, or
+    return None if there are none left. A chemsys this invocation already
+    failed to download is left for the others'''
+    conn.execute('BEGIN IMMEDIATE')
+    # Invocations may have been killed since this one started
+    release_stale_claims(conn)
+    row = conn.execute('SELECT chemsys FROM tasks WHERE status = \'pending\' '
+                       'AND (owner IS NULL OR owner != ?) LIMIT 1',
+                       (owner,)).fetchone()
+    if row is None:
+        conn.execute('COMMIT')
+        return None
+    chemsys = row[0]
+    conn.execute('UPDATE tasks SET status = \'in_progress\', owner = ?, claimed_at = ? '
+                 'WHERE chemsys = ?', (owner, time(), chemsys))
+    conn.execute('COMMIT')
+    return chemsys
+
+def set_task_status(conn, chemsys_list, status):
+    '''Set the status of chemsys's in the queue'''
+    conn.executemany('UPDATE tasks SET status = ? WHERE chemsys = ?',
+                     [(status, chemsys) for chemsys in chemsys_list])
+
+# Time until which downloads are paused after being rate limited, shared by all
+# the download threads
+rate_limit_until = 0
+rate_limit_lock = threading.Lock()
+# Set when the script is stopping, so that the download threads stop waiting
+# and retrying, rather than keeping the script alive for hours
+stop_downloads = threading.Event()
+
+def pause_for_rate_limit(delay):
+    '''Pause downloads in all threads for delay seconds'''
+    global rate_limit_until
+    with rate_limit_lock:
+        rate_limit_until = max(rate_limit_until, time() + delay)
+
+def wait_for_rate_limit():
+    '''If downloads are paused due to the rate limit, wait until the pause
+    is over, or the script is stopping'''
+    while not stop_downloads.is_set():
+        with rate_limit_lock:
+            remaining = rate_limit_until - time()
+        if remaining <= 0:
+            return
+        # Checking again afterwards, in case another thread was rate limited
+        # in the meantime
+        stop_downloads.wait(remaining)
+
+def download_chemsys(mpr, current_symbols, chemsys):
+    '''Download the Pourbaix entries for one chemsys. Returns the row for the
+    downloads table and the entries to save, which are None if there's nothing
+    to save, or None if the download failed and should be tried again on the
+    next run. This runs in worker threads, which share the MPRester and its
+    session'''
+    print(f'Trying symbols: {current_symbols}')
+
+    this_download_tbl_row = dict()
+    this_download_tbl_row['symbols'] = chemsys
+
+    download_start = time()
+    outer_retries = 10
+    # Long outer delay; I think these are due to connection drops on my
+    # end, which can take a while to be restored
+    outer_delay = 30 # seconds
+    successful_download = False
+    # 1-indexing attempts for printing purposes
+    for attempt in range(1, outer_retries+1):
+        # Don't send anything while paused for the rate limit
+        wait_for_rate_limit()
+        if stop_downloads.is_set():
+            print(f'Stopping download of {current_symbols}')
+            # Don't add to table so it tries again when rerun
+            return None
+        # Back off exponentially if this attempt fails, with jitter so that
+        # threads that failed together don't all retry together
+        backoff = min(600, outer_delay * 2**(attempt-1)) * random.uniform(0.5, 1.5)
+        # 1. download the entries (H and O are added automatically)
+        try:
+            pourbaix_entries = mpr.get_pourbaix_entries(current_symbols)
+            successful_download = True
+            break
+        except (ChunkedEncodingError, ConnectionError, ProtocolError,
+                Timeout, IncompleteRead, MPRestError) as e:
+            print(f'Download failed on attempt {attempt}/{outer_retries} to download {current_symbols}, likely due to an interrupted connection, with error {e}')
+            stop_downloads.wait(backoff)
+        # ValueError on Yb
+        except ValueError as e:
+            print(f'Skipping {current_symbols} due to ValueError: {e}')
+            this_download_tbl_row['error'] = str(e)
+            return this_download_tbl_row, None
+        except HTTPError as err:
+            if err.response.status_code == 429:
+                print(f"Rate limited at symbols {current_symbols}: {err}")
+                print("Pausing downloads for 10 minutes to reset rate limit.")
+                # The rate limit applies to all threads, so they all pause
+                pause_for_rate_limit(600)  # pause 10 min
+            else:
+                print(f'Download failed on attempt {attempt}/{outer_retries} to download {current_symbols} due to HTTPError: {err}')
+                stop_downloads.wait(backoff)
+        except RetryError as err:
+            print(f'Download failed on attempt {attempt}/{outer_retries} to download {current_symbols} due to RetryError: {err}')
+            stop_downloads.wait(backoff)
+    if not successful_download:
+        print(f'Skipping {current_symbols} after {attempt} attempts')
+        # Don't add to table so it tries again when rerun
+        return None
+    n_entries = len(pourbaix_entries)
+    this_download_tbl_row['n_entries'] = n_entries
+    if n_entries == 0:
+        print(f'Skipping {current_symbols} because no Pourbaix entries found')
+        return this_download_tbl_row, None
+    download_end = time()
+    download_time = download_end - download_start
+    this_download_tbl_row['download_time'] = download_time
+
+    print(f'Downloaded {n_entries} Pourbaix entries for {current_symbols} in {download_time:.2f} seconds')
+
+    return this_download_tbl_row, pourbaix_entries
+
+def save_entries(writer_queue, download_tbl_rows, writer_errors):
+    '''Save the Pourbaix entries put in the queue, along with their rows for
+    the downloads table, until None is put in the queue. Each row is added to
+    the table once its entries are saved. This runs in its own thread, so
+    that saving one chemsys's entries overlaps with downloading the next. If
+    saving fails other than with an OSError, the error is added to
+    writer_errors and the thread stops, for the main thread to raise'''
+    try:
+        while True:
+            item = writer_queue.get()
+            if item is None:
+                return
+            this_download_tbl_row, pourbaix_entries = item
+            chemsys = this_download_tbl_row['symbols']
+            # Serialize and save the entries. Encoding the whole json string
+            # at once uses the C encoder, which is much faster than streaming
+            # it in pieces, and the string is only a few MB
+            entries_outpath = os.path.join(outdir, f'{chemsys}.json.gz')
+            try:
+                with gzip.open(entries_outpath, 'wt', compresslevel=1) as f:
+                    f.write(ENTRY_ENCODER.encode(pourbaix_entries))
+            except OSError as e:
+                # Don't add to table so it tries again when rerun
+                print(f'Failed to save Pourbaix entries for {chemsys} to {entries_outpath}, with error {e}')
+                continue
+            print(f'Saved {len(pourbaix_entries)} Pourbaix entries for {chemsys} to {entries_outpath}')
+            this_download_tbl_row['entries_outpath'] = entries_outpath
+            download_tbl_rows.append(this_download_tbl_row)
+    except Exception as e:
+        # Passed back to the main thread to raise
+        writer_errors.append(e)
+
+# Download information rows that haven't been saved to the output table yet
 download_tbl_rows = []
+# Number of rows to collect before saving them
+flush_rows = 10
+
+def flush_download_rows():
+    '''Append the download information rows collected so far to the output
+    table, list their chemsys's as downloaded, and mark them done in the
+    queue'''
+    # The writer thread may add rows in the meantime. They go on the end, so
+    # only remove the ones being saved
+    rows = download_tbl_rows[:]
+    del download_tbl_rows[:len(rows)]
+    table_cols = {column: pd.array([row.get(column) for row in rows], dtype=dtype)
+                  for column, dtype in DOWNLOAD_COLUMNS.items()}
+    # Holding the lock on the list of downloaded chemsys's while appending to
+    # the output table too, since invocations sharing a queue share a table
+    with open(downloaded_path, 'a') as downloaded_file:
+        fcntl.flock(downloaded_file, fcntl.LOCK_EX)
+        append_table(table_cols, outtbl_path)
+        # Only list the chemsys's once they're saved in the table
+        downloaded_file.writelines(f'{row["symbols"]}\n' for row in rows)
+    if queue_conn is not None:
+        # Only mark chemsys's done once they're saved in the table
+        set_task_status(queue_conn, [row['symbols'] for row in rows], 'done')
+
+# Entries waiting to be saved. Limiting the size so that downloads don't get
+# too far ahead of saving, holding lots of entries in memory
+writer_queue = queue.Queue(maxsize=4)
+# Errors that stopped the writer thread
+writer_errors = []
+writer = threading.Thread(target=save_entries,
+                          args=(writer_queue, download_tbl_rows, writer_errors),
+                          daemon=True)
+writer.start()
+
+def send_to_writer(item):
+    '''Put an item in the queue for the writer thread. If the writer thread
+    has stopped, raise its error, rather than waiting forever for room in the
+    queue'''
+    while True:
+        if not writer.is_alive():
+            raise RuntimeError('Thread saving Pourbaix entries stopped') \
+                    from (writer_errors[0] if writer_errors else None)
+        try:
+            writer_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
 
 # Make a set of all symbol combinations present in a previously saved list of
 # compositions
 compositions = pd.read_csv('compositions.csv.gz')
+# Aggregating within the groupby avoids making a table for every material, and
+# the order of the groups doesn't matter
 raw_symbol_combinations = set(
-        frozenset(tbl.element.tolist())
-        for material_id, tbl
-        in compositions.groupby('material_id'))
+        compositions.groupby('material_id', sort=False)['element']
+        .agg(frozenset).tolist())
 # Redundant to include H and O, compounds with H and O will be
 # considered during construction of the Pourbaix diagram
-reduced_symbol_combinations = set(
-        frozenset(symbol
-                for symbol in combination
-                if symbol not in frozenset(['H', 'O']))
-        for combination in raw_symbol_combinations)
 # This creates another problem: if H and O are the only symbols present, we'll
 # get the empty set. So filter that out
 symbol_combinations = set(
-        combination
-        for combination in reduced_symbol_combinations
-        if len(combination) > 0)
+        combination - HO_SYMBOLS
+        for combination in raw_symbol_combinations
+        if combination - HO_SYMBOLS)
+# Sort and join by dashes to create a "chemical system" string
+# https://pymatgen.org/pymatgen.core.html?utm_source=chatgpt.com#pymatgen.core.composition.Composition.chemical_system
+# > The chemical system of a Composition, for example “O-Si” for
+# > SiO2. Chemical system is a string of a list of elements sorted
+# > alphabetically and joined by dashes, by convention for use in
+# > database keys.
+# Sorting the list too, so that chemsys's are downloaded in the same order in
+# every run
+chemsys_list = sorted(set(
+        '-'.join(sorted(current_symbols))
+        for current_symbols in symbol_combinations))
+# Decide which chemsys's to download in this run, before connecting to the
+# Materials Project, which isn't needed if there's nothing to download
+# Skip the ones that have been downloaded already
+new_chemsys_list = [chemsys for chemsys in chemsys_list
+                    if chemsys not in prev_symbols]
+print(f'Skipping {len(chemsys_list) - len(new_chemsys_list)} chemsys\'s because they have been downloaded already')
+# Skip the ones that aren't part of this job
+# Assignments are made over all chemsys's, including the ones downloaded
+# already, so that they don't depend on when each job started
+if job_number is not None:
+    chemsys_jobs = assign_jobs(chemsys_list, njobs)
+    todo = [(set(chemsys.split('-')), chemsys)
+            for chemsys in new_chemsys_list
+            if chemsys_jobs[chemsys] == job_number]
+    print(f'Skipping {len(new_chemsys_list) - len(todo)} chemsys\'s because they are not part of job {job_number}')
+else:
+    todo = [(set(chemsys.split('-')), chemsys)
+            for chemsys in new_chemsys_list]
+
+# Identifies this invocation's claims in the queue. Including the host, since
+# the queue may be on a filesystem shared between nodes
+owner = f'{socket.gethostname()}:{getpid()}'
+queue_conn = None
 # pourbaix diagram tutorial:
 # https://matgenb.materialsvirtuallab.org/2017/12/15/plotting-a-pourbaix-diagram.html
 try:
-    with MPRester() as mpr:
-        # My internet is unreliable, so setting up a session that can handle that
-        # Copy-pasting from here:
-        # https://stackoverflow.com/questions/23267409/how-to-implement-retry-mechanism-into-python-requests-library
-        # After running into an hours-long hang, reducing the number of retries
-        # and the backup factor
-        # However, that hang was right before an IP block due to exceeding the
-        # rate limit, so this may not have been necessary
-        inner_retries = 5
-        retry = Retry(total=inner_retries,
-                      read=inner_retries,
-                      connect=inner_retries,
-                      backoff_factor=0.5,
-                      # I've actually gotten 530
-                      # Seems like it's CloudFlare hitting a DNS issue, not
-                      # matproj
-                      # https://community.cloudflare.com/t/community-tip-fixing-error-530-error-1016-origin-dns-error/44264
-                      # Not including 429, "Too Many Requests", because if I
-                      # quickly retry after that, I may just get my IP banned
-                      # again
-                      status_forcelist=(500, 502, 503, 504, 530),
-                      allowed_methods=frozenset(['GET', 'POST']),
-                      raise_on_status=False)
-        adapter = HTTPAdapter(max_retries=retry,
-                # Not sure if this helps
-                pool_maxsize = 100, pool_block = False)
-        mpr.session.mount('http://', adapter)
-        mpr.session.mount('https://', adapter)
-        # Also adding a timeout
-        # Importance of timeouts:
-        # https://findwork.dev/blog/advanced-usage-python-requests-timeouts-retries-hooks
-        # This method for setting them:
-        # https://stackoverflow.com/a/59317604
-        # After still running into hours-long hangs, using a higher timeout.
-        # This is the timeout for an individual request, so I think the hang
-        # was in the Retry; trying to let it wait out problems rather than run
-        # into the exponentially long backups in Retry
-        mpr.session.request = functools.partial(mpr.session.request, timeout=60)
-        for current_symbols in symbol_combinations:
-            print(f'Trying symbols: {current_symbols}')
-
-            this_download_tbl_row = dict()
-            # Sort and join by dashes to create a "chemical system" string
-            # https://pymatgen.org/pymatgen.core.html?utm_source=chatgpt.com#pymatgen.core.composition.Composition.chemical_system
-            # > The chemical system of a Composition, for example “O-Si” for
-            # > SiO2. Chemical system is a string of a list of elements sorted
-            # > alphabetically and joined by dashes, by convention for use in
-            # > database keys.
-            chemsys = '-'.join(sorted(current_symbols))
-            this_download_tbl_row['symbols'] = chemsys
-
-            # Skip if this one has been downloaded already
-            if chemsys in prev_symbols:
-                print(f'Skipping {chemsys} because it has been downloaded already')
-                continue
+    if args.queue is not None:
+        # With a queue, the chemsys's are claimed one at a time below
+        # instead, and may be downloaded by another invocation
+        queue_conn = init_queue(args.queue,
+                [chemsys for current_symbols, chemsys in todo],
+                prev_symbols)
 
-            # Skip if this chemsys is a part of this job
-            if job_number is not None:
-                # Get the job number for this chemsys
-                chemsys_job_number = string2job(chemsys, njobs)
-                if chemsys_job_number != job_number:
-                    print(f'Skipping {chemsys} because it is not part of job {job_number}')
-                    continue
-
-            download_start = time()
-            outer_retries = 10
-            # Long outer delay; I think these are due to connection drops on my
-            # end, which can take a while to be restored
-            outer_delay = 30 # seconds
-            successful_download = False
-            # 1-indexing attempts for printing purposes
-            for attempt in range(1, outer_retries+1):
-                # 1. download the entries (H and O are added automatically)
-                try:
-                    pourbaix_entries = mpr.get_pourbaix_entries(current_symbols)
-                    successful_download = True
-                    break
-                except (ChunkedEncodingError, ConnectionError, ProtocolError,
-                        Timeout, IncompleteRead, MPRestError) as e:
-                    print(f'Download failed on attempt {attempt}/{outer_retries} to download {current_symbols}, likely due to an interrupted connection, with error {e}')
-                    sleep(outer_delay)
-                # ValueError on Yb
-                except ValueError as e:
-                    print(f'Skipping {current_symbols} due to ValueError: {e}')
-                    this_download_tbl_row['error'] = str(e)
-                    download_tbl_rows.append(this_download_tbl_row)
-                    break
-                except HTTPError as err:
-                    if err.response.status_code == 429:
-                        print(f"Rate limited at symbols {current_symbols}: {err}")
-                        print("Pausing for 10 minutes to reset rate limit.")
-                        sleep(600)  # pause 10 min
-                    else:
-                        print(f'Download failed on attempt {attempt}/{outer_retries} to download {current_symbols} due to HTTPError: {err}')
-                        sleep(outer_delay)
-                except RetryError as err:
-                    print(f'Download failed on attempt {attempt}/{outer_retries} to download {current_symbols} due to RetryError: {err}')
-                    sleep(outer_delay)
-            if not successful_download:
-                print(f'Skipping {current_symbols} after {attempt} attempts')
-                # Don't add to table so it tries again when rerun
-                continue
-            n_entries = len(pourbaix_entries)
-            this_download_tbl_row['n_entries'] = n_entries
-            if n_entries == 0:
-                print(f'Skipping {current_symbols} because no Pourbaix entries found')
-                download_tbl_rows.append(this_download_tbl_row)
-                continue
-            download_end = time()
-            download_time = download_end - download_start
-            this_download_tbl_row['download_time'] = download_time
+    if not todo:
+        print('Nothing to download')
+    else:
+        with MPRester() as mpr:
+            # My internet is unreliable, so setting up a session that can handle that
+            # Copy-pasting from here:
+            # https://stackoverflow.com/questions/23267409/how-to-implement-retry-mechanism-into-python-requests-library
+            # After running into an hours-long hang, reducing the number of retries
+            # and the backup factor
+            # However, that hang was right before an IP block due to exceeding the
+            # rate limit, so this may not have been necessary
+            inner_retries = 5
+            retry = Retry(total=inner_retries,
+                          read=inner_retries,
+                          connect=inner_retries,
+                          backoff_factor=0.5,
+                          # I've actually gotten 530
+                          # Seems like it's CloudFlare hitting a DNS issue, not
+                          # matproj
+                          # https://community.cloudflare.com/t/community-tip-fixing-error-530-error-1016-origin-dns-error/44264
+                          # Not including 429, "Too Many Requests", because if I
+                          # quickly retry after that, I may just get my IP banned
+                          # again
+                          status_forcelist=(500, 502, 503, 504, 530),
+                          allowed_methods=frozenset(['GET', 'POST']),
+                          raise_on_status=False)
+            # Also adding a timeout
+            # Importance of timeouts:
+            # https://findwork.dev/blog/advanced-usage-python-requests-timeouts-retries-hooks
+            # After still running into hours-long hangs, using a higher timeout.
+            # This is the timeout for an individual request, so I think the hang
+            # was in the Retry; trying to let it wait out problems rather than run
+            # into the exponentially long backups in Retry
+            # Keep-alive is the default for a session, so keeping enough pooled
+            # connections around for every download thread means connections get
+            # reused rather than set up again for each chemsys
+            adapter = TimeoutHTTPAdapter(timeout=60, max_retries=retry,
+                    pool_connections = 32, pool_maxsize = 128, pool_block = False)
+            mpr.session.mount('http://', adapter)
+            mpr.session.mount('https://', adapter)
+            # The ion reference data is the same for every chemsys. The MPRester
+            # caches it after the first download, so download it here, before
+            # several threads each find it missing and download it at once. If
+            # this fails, the threads download it after all
+            try:
+                mpr.get_ion_reference_data()
+            except (ChunkedEncodingError, ConnectionError, ProtocolError, Timeout,
+                    IncompleteRead, MPRestError, HTTPError, RetryError) as e:
+                print(f'Failed to download ion reference data ahead of time, with error {e}')
 
-            print(f'Downloaded {n_entries} Pourbaix entries for {current_symbols} in {download_time:.2f} seconds')
+            def next_task():
+                '''Get the next chemsys to download, or None if there are none
+                left'''
+                if args.queue is not None:
+                    chemsys = claim_task(queue_conn, owner)
+                    if chemsys is None:
+                        return None
+                    return set(chemsys.split('-')), chemsys
+                elif todo:
+                    return todo.pop(0)
+                else:
+                    return None
 
-            # Serialize and save the entries
-            serialized_text = pourbaix2json(pourbaix_entries)
-            entries_outpath = os.path.join(outdir, f'{chemsys}.json.gz')
-            with gzip.open(entries_outpath, 'wt') as f:
-                f.write(serialized_text)
-                print(f'Saved {n_entries} Pourbaix entries for {current_symbols} to {entries_outpath}')
-            this_download_tbl_row['entries_outpath'] = entries_outpath
+            # Downloads spend nearly all their time waiting on the network, so
+            # run several at once in threads sharing the session
+            # Only take a new chemsys when a thread is nearly free for it, so that
+            # with a queue, other invocations can claim the rest. One more than the
+            # number of threads waits in the executor, so that a thread finishing
+            # a download starts the next one right away, rather than waiting for
+            # the main thread to hand it over. Saving is already overlapped with
+            # downloading by the writer thread
+            max_in_flight = args.threads + 1
+            executor = ThreadPoolExecutor(max_workers=args.threads)
+            in_flight = dict()
 
-            # Wrapping up
-            download_tbl_rows.append(this_download_tbl_row)
+            def record_result(chemsys, result):
+                '''Save the result of downloading a chemsys, or, if the
+                download failed, leave it to be tried again'''
+                if result is not None:
+                    this_download_tbl_row, pourbaix_entries = result
+                    if pourbaix_entries is None:
+                        download_tbl_rows.append(this_download_tbl_row)
+                    else:
+                        send_to_writer((this_download_tbl_row, pourbaix_entries))
+                elif args.queue is not None:
+                    # Leave it to another invocation to try again
+                    set_task_status(queue_conn, [chemsys], 'pending')
+
+            try:
+                while True:
+                    while len(in_flight) < max_in_flight:
+                        task = next_task()
+                        if task is None:
+                            break
+                        current_symbols, chemsys = task
+                        future = executor.submit(download_chemsys, mpr, current_symbols, chemsys)
+                        in_flight[future] = chemsys
+                    if not in_flight:
+                        break
+                    done, not_done = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        chemsys = in_flight.pop(future)
+                        record_result(chemsys, future.result())
+                    # Save progress every so often, so that it isn't lost if the
+                    # script is killed
+                    if len(download_tbl_rows) >= flush_rows:
+                        flush_download_rows()
+            finally:
+                # On an interrupt, don't start any more downloads, and stop the
+                # ones in progress from waiting or retrying. The threads aren't
+                # daemons, so the script can't exit until they stop anyway
+                stop_downloads.set()
+                executor.shutdown(wait=True, cancel_futures=True)
+                # Save the downloads that finished in the meantime. Their rows
+                # get saved below
+                for future, chemsys in in_flight.items():
+                    if future.done() and not future.cancelled() \
+                            and future.exception() is None:
+                        record_result(chemsys, future.result())
 finally:
-    # If there was a previous output table, concatenate the rows
-    # Actually, concatenate the rows in any case; if there was no previous table,
-    # it will be empty
-    new_output_tbl = pd.DataFrame(download_tbl_rows)
-    final_output_tbl = pd.concat([prev_output, new_output_tbl], ignore_index=True)
-    # Save the output table
-    final_output_tbl.to_csv(outtbl_path, index=False)
+    # Finish saving the entries that have been downloaded. If the writer
+    # thread has stopped, still save the rows of the ones it did save
+    try:
+        send_to_writer(None)
+    except RuntimeError:
+        pass
+    writer.join()
+    flush_download_rows()
+    if queue_conn is not None:
+        # Any chemsys's still claimed were interrupted, so put them back for
+        # someone else
+        queue_conn.execute('UPDATE tasks SET status = \'pending\' '
+                           'WHERE status = \'in_progress\' AND owner = ?',
+                           (owner,))
+        queue_conn.close()
+    if writer_errors:
+        raise RuntimeError('Failed to save Pourbaix entries') from writer_errors[0]
@@ -57,41 +57,41 @@ with MPRester(monty_decode=False, use_document_model=False) as mpr:
             fields=['material_id', 'band_gap', 'energy_above_hull',
                 'theoretical', 'deprecated', 'composition'],
             num_chunks = None)
-# Create list of rows for the output table of properties
-property_rows = []
-# Create a list of rows for the output table of compositions
-composition_rows = []
-for entry in entries:
-    # RETRIEVE PROPERTIES
-    this_property_row = dict()
-    this_property_row['material_id'] = entry['material_id']
-    this_property_row['band_gap'] = entry['band_gap']
-    this_property_row['energy_above_hull'] = entry['energy_above_hull']
-    this_property_row['deprecated'] = entry['deprecated']
-    # Theoretical is a boolean; it's the negation of the "Synthesizable"
-    # property indicated with a star in the web interface:
-    # https://matsci.org/t/obtain-star-materials/51386/2
-    # It actually just means the material isn't present in ICSD:
-    # https://matsci.org/t/how-is-the-theoretical-tag-determined/3527
-    this_property_row['theoretical'] = entry['theoretical']
-    property_rows.append(this_property_row)
+# RETRIEVE PROPERTIES
+# The entries are dictionaries already, so pandas can pick out the columns of
+# the output table of properties itself
+# Theoretical is a boolean; it's the negation of the "Synthesizable"
+# property indicated with a star in the web interface:
+# https://matsci.org/t/obtain-star-materials/51386/2
+# It actually just means the material isn't present in ICSD:
+# https://matsci.org/t/how-is-the-theoretical-tag-determined/3527
+property_df = pd.DataFrame.from_records(entries,
+        columns=['material_id', 'band_gap', 'energy_above_hull',
+                 'deprecated', 'theoretical'])
 
-    # RETRIEVE COMPOSITION
-    # Ideally I would use reduced composition, but without the document model I
-    # don't see how
-    these_composition_rows = \
-            [{'material_id': entry['material_id'],
-                'element': key,
-                'amount': value} \
-             for key, value \
-             in entry['composition'].items()]
-    composition_rows.extend(these_composition_rows)
+# RETRIEVE COMPOSITION
+# Ideally I would use reduced composition, but without the document model I
+# don't see how
+# The output table of compositions has a row for each element of each
+# material. Exploding the (element, amount) pairs gives one per row, with the
+# index of the material it came from. Materials with an empty composition
+# explode to a missing value, so drop those
+material_compositions = pd.DataFrame.from_records(entries,
+        columns=['material_id', 'composition'])
+element_amounts = material_compositions['composition'] \
+        .map(lambda composition: list(composition.items())) \
+        .explode().dropna()
+composition_df = pd.DataFrame(element_amounts.tolist(),
+                              columns=['element', 'amount'])
+composition_df.insert(0, 'material_id',
+        material_compositions['material_id'].to_numpy()[element_amounts.index])
 
-# Save a csv file with the table constructed from the property rows
+# Save a csv file with the table of properties
+# Fastest gzip level; the size savings from higher levels are small
 outpath = 'precomputed_properties.csv.gz'
-property_df = pd.DataFrame(property_rows)
-property_df.to_csv(outpath, index=False)
+property_df.to_csv(outpath, index=False,
+        compression={'method': 'gzip', 'compresslevel': 1})
 # Also save a csv file containing the compositions
 composition_outpath = 'compositions.csv.gz'
-composition_df = pd.DataFrame(composition_rows)
-composition_df.to_csv(composition_outpath, index=False)
+composition_df.to_csv(composition_outpath, index=False,
+        compression={'method': 'gzip', 'compresslevel': 1})